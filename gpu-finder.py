@@ -21,41 +21,107 @@ an image.
 For more information, see the README.md under /compute.
 """
 
+import itertools
+import random
+import re
+import threading
 import time
 import json
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait as wait_futures
+import google_auth_httplib2
 import googleapiclient.discovery
+import googleapiclient.http
+from googleapiclient.errors import HttpError
+import httplib2
+
+MAX_BATCH_SIZE = 100
+MAX_WORKERS = 32
+HTTP_TIMEOUT = 150
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+GPU_QUOTA_METRICS = {
+    'nvidia-h100-80gb': 'NVIDIA_H100_GPUS',
+    'nvidia-h100-mega-80gb': 'NVIDIA_H100_MEGA_GPUS',
+    'nvidia-h200-141gb': 'NVIDIA_H200_GPUS',
+}
+A2_GPU_COUNT_RE = re.compile(r'^a2-(?:high|mega|ultra)gpu-(\d+)g$')
+
+thread_local = threading.local()
+
+class InstanceCreationError(Exception):
+    # Raised by create_instance after a hard failure, carrying the instances that
+    # were created before (or while) it happened so they can still be deleted.
+    def __init__(self, created_instances):
+        super().__init__(f"Instance creation failed after creating {len(created_instances)} instances")
+        self.created_instances = created_instances
+
+def execute_with_retry(request, max_attempts=8):
+    # Retries rate limited and server errors with jittered exponential backoff,
+    # honoring the Retry-After header when the API sends one. Inserts and deletes
+    # carry a requestId so the server treats a retried call as the same request.
+    for attempt in range(max_attempts):
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status not in RETRY_STATUSES or attempt == max_attempts - 1:
+                raise
+            try:
+                delay = float(e.resp.get('retry-after', 0))
+            except ValueError:
+                delay = 0
+            delay = min(delay or (2**attempt + random.random()), 60)
+            print(f"Request failed with status {e.resp.status}, retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+
+def build_request(http, *args, **kwargs):
+    # httplib2.Http is not thread-safe, so each thread keeps its own transport that
+    # shares the credentials of the service's authorized http. Reusing it per thread
+    # keeps connections alive instead of doing a TLS handshake for every request.
+    thread_http = getattr(thread_local, 'http', None)
+    if thread_http is None:
+        # Mirrors googleapiclient.http.build_http, with a timeout that outlasts the
+        # server-side hold of zoneOperations.wait.
+        base_http = httplib2.Http(timeout=HTTP_TIMEOUT)
+        base_http.redirect_codes = base_http.redirect_codes - {308}
+        thread_http = google_auth_httplib2.AuthorizedHttp(http.credentials, http=base_http)
+        thread_local.http = thread_http
+    return googleapiclient.http.HttpRequest(thread_http, *args, **kwargs)
 
 def check_gpu_config(config):
     compute_config = config
-    if compute_config['instance_config']['machine_type'].startswith('a2'):
+    a2_match = A2_GPU_COUNT_RE.match(compute_config['instance_config']['machine_type'])
+    if a2_match:
         number_of_gpus_requested = compute_config['instance_config']['number_of_gpus']
-        gpus_in_machine_type = compute_config['instance_config']['machine_type'][(compute_config['instance_config']['machine_type'].find('highgpu')+8):(len(compute_config['instance_config']['machine_type'])-1)]
-        if number_of_gpus_requested != int(gpus_in_machine_type):
+        if number_of_gpus_requested != int(a2_match.group(1)):
             raise Exception("Please match the number of GPUs parameter with the correct machine type in the config file")
 
 def get_zone_info(compute, project):
     zone_list = []
-    request = compute.zones().list(project=project)
+    request = compute.zones().list(project=project, filter='status = "UP"', fields='items(name),nextPageToken')
     while request is not None:
-        response = request.execute()
-        for zone in response['items']:
-            if zone['status'] == 'UP':
-                zone_regions = {
-                    'region': zone['name'][0:len(zone['name'])-2],
-                    'zone': zone['name']
-                }
-                zone_list.append(zone_regions)
+        response = execute_with_retry(request)
+        for zone in response.get('items', []):
+            zone_regions = {
+                'region': zone['name'][0:len(zone['name'])-2],
+                'zone': zone['name']
+            }
+            zone_list.append(zone_regions)
         request = compute.zones().list_next(previous_request=request, previous_response=response)
     return zone_list
 
 def check_machine_type_and_accelerator(compute, project, machine_type, gpu_type, zones):
-    zone_list = zones
+    zone_lookup = {z['zone']: z for z in zones}
     available_zones = []
-    for zone in zone_list:
-        request = compute.machineTypes().list(project=project, zone=zone['zone'])
-        while request is not None:
-            response = request.execute()
-            for machine in response['items']:
+    request = compute.machineTypes().aggregatedList(project=project, filter=f'name = "{machine_type}"', maxResults=500,
+                                                    fields='items/*/machineTypes(name,guestCpus,description,accelerators),nextPageToken')
+    while request is not None:
+        response = execute_with_retry(request)
+        for scope_name, scope in response.get('items', {}).items():
+            zone = zone_lookup.get(scope_name.split('/')[-1])
+            if zone is None:
+                continue
+            for machine in scope.get('machineTypes', []):
                 if 'accelerators' in machine and machine['name'] == machine_type and machine['accelerators'][0]['guestAcceleratorType'] == gpu_type:
                     zones_with_instances = {
                         'machine_type': machine['name'],
@@ -75,260 +141,421 @@ def check_machine_type_and_accelerator(compute, project, machine_type, gpu_type,
                         'description': machine['description']
                     }
                     available_zones.append(zones_with_instances)
-            request = compute.machineTypes().list_next(previous_request=request, previous_response=response)
+        request = compute.machineTypes().aggregatedList_next(previous_request=request, previous_response=response)
     if not available_zones:
         raise Exception(f"No machine types of {machine_type} are available")
     return available_zones
 
 def get_accelerator_quota(compute, project, config, zone, requested_gpus):
-    zone_list = zone
+    zone_lookup = {z['zone']: z for z in zone}
     accelerator_list = []
-    for i in zone_list:
-        request = compute.acceleratorTypes().list(project=project, zone=i['zone'])
-        while request is not None:
-            response = request.execute()
-            if 'items' in response:
-                for accelerator in response['items']:
-                    if accelerator['name'] == config['instance_config']['gpu_type']:
-                        if requested_gpus <= accelerator['maximumCardsPerInstance']:
-                            accelerator_dict = {
-                                "region": i['region'],
-                                "zone": i['zone'],
-                                "machine_type": i['machine_type'],
-                                "guest_cpus": i['guest_cpus'],
-                                "name": accelerator['name'],
-                                "description": accelerator['description'],
-                                "maximum number of GPUs per instance": accelerator['maximumCardsPerInstance']
-                            }
-                            accelerator_list.append(accelerator_dict)
-                            print(f"{requested_gpus} GPUs requested per instance, {i['zone']} has {accelerator['name']} GPUs with a maximum of {accelerator['maximumCardsPerInstance']} per instance")
-                        else:
-                            print(
-                                f"{requested_gpus} GPUs requested per instance, {i['zone']} doesn't have enough GPUs, with a maximum of {accelerator['maximumCardsPerInstance']} per instance")
-            request = compute.acceleratorTypes().list_next(previous_request=request, previous_response=response)
+    gpu_type = config['instance_config']['gpu_type']
+    request = compute.acceleratorTypes().aggregatedList(project=project, filter=f'name = "{gpu_type}"', maxResults=500,
+                                                        fields='items/*/acceleratorTypes(name,description,maximumCardsPerInstance),nextPageToken')
+    while request is not None:
+        response = execute_with_retry(request)
+        for scope_name, scope in response.get('items', {}).items():
+            i = zone_lookup.get(scope_name.split('/')[-1])
+            if i is None:
+                continue
+            for accelerator in scope.get('acceleratorTypes', []):
+                if accelerator['name'] == gpu_type:
+                    if requested_gpus <= accelerator['maximumCardsPerInstance']:
+                        accelerator_dict = {
+                            "region": i['region'],
+                            "zone": i['zone'],
+                            "machine_type": i['machine_type'],
+                            "guest_cpus": i['guest_cpus'],
+                            "name": accelerator['name'],
+                            "description": accelerator['description'],
+                            "maximum number of GPUs per instance": accelerator['maximumCardsPerInstance']
+                        }
+                        accelerator_list.append(accelerator_dict)
+                        print(f"{requested_gpus} GPUs requested per instance, {i['zone']} has {accelerator['name']} GPUs with a maximum of {accelerator['maximumCardsPerInstance']} per instance")
+                    else:
+                        print(
+                            f"{requested_gpus} GPUs requested per instance, {i['zone']} doesn't have enough GPUs, with a maximum of {accelerator['maximumCardsPerInstance']} per instance")
+        request = compute.acceleratorTypes().aggregatedList_next(previous_request=request, previous_response=response)
     if not accelerator_list:
-        raise Exception(f"No accelerator types of {config['instance_config']['gpu_type']} are available with {config['instance_config']['machine_type']} in any zone, or wrong number of GPUs requested")
+        raise Exception(f"No accelerator types of {gpu_type} are available with {config['instance_config']['machine_type']} in any zone, or wrong number of GPUs requested")
     return accelerator_list
 
 
-def create_instance(compute, project, config, zone_list):
+def gpu_quota_metric(gpu_type):
+    # e.g. nvidia-tesla-t4 -> NVIDIA_T4_GPUS, nvidia-a100-80gb -> NVIDIA_A100_80GB_GPUS.
+    # Newer types whose quota metric drops the memory size are listed in GPU_QUOTA_METRICS.
+    if gpu_type in GPU_QUOTA_METRICS:
+        return GPU_QUOTA_METRICS[gpu_type]
+    model = gpu_type.replace('nvidia-tesla-', '').replace('nvidia-', '')
+    return f"NVIDIA_{model.upper().replace('-', '_')}_GPUS"
+
+def remaining_quota(quotas, metric):
+    for quota in quotas:
+        if quota['metric'] == metric:
+            return int(quota['limit'] - quota['usage'])
+    return None
+
+def check_gpu_quota(compute, project, config, zone_list, requested_gpus):
+    metric = gpu_quota_metric(config['instance_config']['gpu_type'])
+    project_info = execute_with_retry(compute.projects().get(project=project, fields='quotas'))
+    global_remaining = remaining_quota(project_info.get('quotas', []), 'GPUS_ALL_REGIONS')
+    if global_remaining is not None:
+        print(f"{global_remaining} GPUs remaining in the GPUS_ALL_REGIONS quota")
+        if global_remaining < requested_gpus:
+            raise Exception(f"{requested_gpus} GPUs requested per instance, but only {global_remaining} remain in the GPUS_ALL_REGIONS quota")
+
+    regions = list({z['region'] for z in zone_list})
+    regional_remaining = {}
+
+    def on_region(request_id, response, exception):
+        if exception is not None:
+            raise exception
+        regional_remaining[regions[int(request_id)]] = remaining_quota(response.get('quotas', []), metric)
+
+    requests = [compute.regions().get(project=project, region=region, fields='quotas') for region in regions]
+    execute_in_batches(compute, requests, on_region)
+
+    zones_with_quota = []
+    for z in zone_list:
+        regional = regional_remaining[z['region']]
+        remaining = regional
+        if global_remaining is not None:
+            remaining = global_remaining if remaining is None else min(remaining, global_remaining)
+        if remaining is not None and remaining < requested_gpus:
+            continue
+        # The global quota is the same for every region, so only the regional figure
+        # is useful for ranking zones
+        z['regional_remaining_gpus'] = regional
+        zones_with_quota.append(z)
+    for region, remaining in regional_remaining.items():
+        if remaining is None:
+            print(f"No {metric} quota found in {region}, its zones will be tried without a quota check")
+        elif remaining < requested_gpus:
+            print(f"Skipping {region}, {requested_gpus} GPUs requested per instance and only {remaining} {metric} quota remaining")
+    if not zones_with_quota:
+        raise Exception(f"No regions have enough {metric} quota remaining for {requested_gpus} GPUs per instance")
+    return zones_with_quota
+
+
+def build_instance_template(config, source_disk_image):
+    # The parts of the instance body that are the same in every zone; start_insert
+    # fills in the name and the zone-specific URLs.
     compute_config = config
-    regions_to_try = list({v['region'] for v in zone_list})
-    created_instances = []
-    instances = 0
-    regions_attempted = 0
-    print(f"There are {len(regions_to_try)} regions to try that match the GPU type and machine type configuration.")
-    for region in regions_to_try:
-        print(f"Attempting to create instances in {region}")
-        zones = [z for z in zone_list if z['region'] == region]
-        print(f"There are {len(zones)} zones to try in {region}")
-        zones_attempted = 0
-        move_regions = 0
-        for i in range(len(zones)):
-            zone_config = zones[i]
-            for j in range(compute_config['number_of_instances']):
-                print(f"Creating instance number {instances+1} of {compute_config['number_of_instances']} in {zone_config['zone']}, zone {zones_attempted+1} out of {len(zones)} attempted.")
-                image_project = compute_config['instance_config']['image_project']
-                image_family = compute_config['instance_config']['image_family']
-                image_response = compute.images().getFromFamily(
-                    project=image_project, family=image_family).execute()
-                source_disk_image = image_response['selfLink']
-                instance_name = compute_config['instance_config']['name'] + '-' + str(instances+1) + '-' + zone_config['zone']
-                # Configure the machine
-                machine_type = f"zones/{zone_config['zone']}/machineTypes/{compute_config['instance_config']['machine_type']}"
-                # startup_script = open(
-                #     os.path.join(
-                #         os.path.dirname(__file__), 'startup-script.sh'), 'r').read()
-                # image_url = "http://storage.googleapis.com/gce-demo-input/photo.jpg"
-                # image_caption = "Ready for dessert?"
-
-                config = {
-                    'name': instance_name,
-                    'machineType': machine_type,
-
-                    # Specify the boot disk and the image  to use as a source.
-                    'disks': [
-                        {
-                            'kind': 'compute#attachedDisk',
-                            'type': 'PERSISTENT',
-                            'boot': True,
-                            'mode': 'READ_WRITE',
-                            'autoDelete': True,
-                            'deviceName': compute_config['instance_config']['name'],
-                            'initializeParams': {
-                                'sourceImage': source_disk_image,
-                                'diskType': f"projects/{project}/zones/{zone_config['zone']}/diskTypes/{compute_config['instance_config']['disk_type']}",
-                                'diskSizeGb': compute_config['instance_config']['disk_size'],
-                                'labels': {}
-                            },
-                            "diskEncryptionKey": {}
-                        }
-                    ],
-                    'canIpForward': False,
-                    'guestAccelerators': [
-                        {
-                            'acceleratorCount': compute_config['instance_config']['number_of_gpus'],
-                            'acceleratorType': f"zones/{zone_config['zone']}/acceleratorTypes/{compute_config['instance_config']['gpu_type']}"
-                        }
-                    ],
-
-                    'tags': {
-                        "items": compute_config['instance_config']['firewall_rules']
-                    },
-
-                    # Specify a network interface with NAT to access the public
-                    # internet.
-                    'networkInterfaces': [{
-                        'kind': 'compute#networkInterface',
-                        'network': compute_config['instance_config']['network_interfaces']['network'],
-                        'accessConfigs': [
-                            {
-                                'kind': 'compute#accessConfig',
-                                'name': 'External NAT',
-                                'type': 'ONE_TO_ONE_NAT',
-                                'networkTier': 'PREMIUM'
-                            }
-                        ],
-                        'aliasIpRanges': []
-                    }
-                    ],
-                    'description': '',
-                    'labels': {},
-                    'scheduling': {
-                        'preemptible': False,
-                        'onHostMaintenance': 'TERMINATE',
-                        'automaticRestart': True,
-                        'nodeAffinities': []
-                    },
-                    'deletionProtection': False,
-                    'reservationAffinity': {
-                        'consumeReservationType': 'ANY_RESERVATION'
-                    },
-                    # Allow the instance to access cloud storage and logging.
-                    'serviceAccounts': [{
-                        'email': compute_config['instance_config']['identity_and_api_access']['service_account_email'],
-                        'scopes': [
-                            compute_config['instance_config']['identity_and_api_access']['scopes']
-                        ]
-                    }
-                    ],
-                    'shieldedInstanceConfig': {
-                        'enableSecureBoot': False,
-                        'enableVtpm': True,
-                        'enableIntegrityMonitoring': True
-                    },
-
-                    'confidentialInstanceConfig': {
-                        'enableConfidentialCompute': False
-                    },
-
-                    # Metadata is readable from the instance and allows you to
-                    # pass configuration from deployment scripts to instances.
-                    'metadata': {
-                        'kind': 'compute#metadata',
-                        'items': [],
-                    }
+    # startup_script = open(
+    #     os.path.join(
+    #         os.path.dirname(__file__), 'startup-script.sh'), 'r').read()
+    # image_url = "http://storage.googleapis.com/gce-demo-input/photo.jpg"
+    # image_caption = "Ready for dessert?"
+
+    instance_template = {
+        # Specify the boot disk and the image  to use as a source.
+        'disks': [
+            {
+                'kind': 'compute#attachedDisk',
+                'type': 'PERSISTENT',
+                'boot': True,
+                'mode': 'READ_WRITE',
+                'autoDelete': True,
+                'deviceName': compute_config['instance_config']['name'],
+                'initializeParams': {
+                    'sourceImage': source_disk_image,
+                    'diskSizeGb': compute_config['instance_config']['disk_size'],
+                    'labels': {}
+                },
+                "diskEncryptionKey": {}
+            }
+        ],
+        'canIpForward': False,
+
+        'tags': {
+            "items": compute_config['instance_config']['firewall_rules']
+        },
+
+        # Specify a network interface with NAT to access the public
+        # internet.
+        'networkInterfaces': [{
+            'kind': 'compute#networkInterface',
+            'network': compute_config['instance_config']['network_interfaces']['network'],
+            'accessConfigs': [
+                {
+                    'kind': 'compute#accessConfig',
+                    'name': 'External NAT',
+                    'type': 'ONE_TO_ONE_NAT',
+                    'networkTier': 'PREMIUM'
                 }
+            ],
+            'aliasIpRanges': []
+        }
+        ],
+        'description': '',
+        'labels': {},
+        'scheduling': {
+            'preemptible': False,
+            'onHostMaintenance': 'TERMINATE',
+            'automaticRestart': True,
+            'nodeAffinities': []
+        },
+        'deletionProtection': False,
+        'reservationAffinity': {
+            'consumeReservationType': 'ANY_RESERVATION'
+        },
+        # Allow the instance to access cloud storage and logging.
+        'serviceAccounts': [{
+            'email': compute_config['instance_config']['identity_and_api_access']['service_account_email'],
+            'scopes': [
+                compute_config['instance_config']['identity_and_api_access']['scopes']
+            ]
+        }
+        ],
+        'shieldedInstanceConfig': {
+            'enableSecureBoot': False,
+            'enableVtpm': True,
+            'enableIntegrityMonitoring': True
+        },
 
-                print(f"Creating instance {instance_name}.")
-                operation = compute.instances().insert(
-                    project=project,
-                    zone=zone_config['zone'],
-                    body=config).execute()
-
-                print('Waiting for operation to finish...')
-                move_zones = 0
-                while True:
-                    result = compute.zoneOperations().get(
-                        project=project,
-                        zone=zone_config['zone'],
-                        operation=operation['name']).execute()
-
-                    if result['status'] == 'DONE':
-                        print("done.")
-                        if 'error' in result:
-                            error_results = result['error']['errors']
-                            if error_results[0]['code'] in ('QUOTA_EXCEEDED', 'ZONE_RESOURCE_POOL_EXHAUSTED_WITH_DETAILS'):
-                                move_regions = 1
-                                print(Exception(result['error']))
-                            else:
-                                raise Exception(result['error'])
-                        else:
-                            instances += 1
-                            move_regions = 0
-                            print(f"Success: {instance_name} created")
-                            print(f"{instances} created, {compute_config['number_of_instances']-instances} more to create")
-                            instance_details = {
-                                "name": instance_name,
-                                "zone": zone_config['zone']
-                            }
-                            created_instances.append(instance_details)
-                        break
-                if instances >= compute_config['number_of_instances']:
-                    print(f"Reached the desired number of instances")
-                    break
-                elif move_regions == 1:
-                    print(f"Quota exceeded in region {region}, moving to next region")
+        'confidentialInstanceConfig': {
+            'enableConfidentialCompute': False
+        },
+
+        # Metadata is readable from the instance and allows you to
+        # pass configuration from deployment scripts to instances.
+        'metadata': {
+            'kind': 'compute#metadata',
+            'items': [],
+        }
+    }
+
+    return instance_template
+
+def start_insert(compute, project, config, zone_config, instance_name, instance_template):
+    compute_config = config
+    zone = zone_config['zone']
+    boot_disk = instance_template['disks'][0]
+    config = dict(instance_template)
+    config['name'] = instance_name
+    # Configure the machine
+    config['machineType'] = f"zones/{zone}/machineTypes/{compute_config['instance_config']['machine_type']}"
+    config['disks'] = [{
+        **boot_disk,
+        'initializeParams': {
+            **boot_disk['initializeParams'],
+            'diskType': f"projects/{project}/zones/{zone}/diskTypes/{compute_config['instance_config']['disk_type']}"
+        }
+    }]
+    config['guestAccelerators'] = [
+        {
+            'acceleratorCount': compute_config['instance_config']['number_of_gpus'],
+            'acceleratorType': f"zones/{zone}/acceleratorTypes/{compute_config['instance_config']['gpu_type']}"
+        }
+    ]
+
+    operation = execute_with_retry(compute.instances().insert(
+        project=project,
+        zone=zone,
+        body=config,
+        requestId=str(uuid.uuid4())))
+    return operation['name']
+
+def poll_operation(compute, project, zone, operation_name):
+    # zoneOperations.wait blocks server-side until the operation is DONE or
+    # roughly two minutes pass, so there is no need to sleep between calls.
+    while True:
+        result = execute_with_retry(compute.zoneOperations().wait(
+            project=project,
+            zone=zone,
+            operation=operation_name))
+
+        if result['status'] == 'DONE':
+            return result
+
+def create_single_instance(compute, project, config, zone_config, instance_name, instance_template):
+    operation_name = start_insert(compute, project, config, zone_config, instance_name, instance_template)
+
+    print(f"Waiting for {instance_name} in {zone_config['zone']} to finish...")
+    result = poll_operation(compute, project, zone_config['zone'], operation_name)
+    print(f"{instance_name} in {zone_config['zone']} done.")
+    if 'error' in result:
+        error_results = result['error']['errors']
+        if error_results[0]['code'].startswith(('QUOTA_EXCEEDED', 'ZONE_RESOURCE_POOL_EXHAUSTED')):
+            print(f"{instance_name} in {zone_config['zone']} failed: {result['error']}")
+            return False
+        raise Exception(result['error'])
+    print(f"Success: {instance_name} created")
+    return True
+
+def create_instance(compute, project, config, zone_list):
+    compute_config = config
+    number_of_instances = compute_config['number_of_instances']
+    regional_zone_lists = defaultdict(list)
+    # Regions with the most remaining GPU quota are the most likely to succeed, so try
+    # them first, leaving regions with unknown quota for last
+    for z in sorted(zone_list, key=lambda z: (z.get('regional_remaining_gpus') is None, -(z.get('regional_remaining_gpus') or 0))):
+        regional_zone_lists[z['region']].append(z)
+    print(f"There are {len(regional_zone_lists)} regions to try that match the GPU type and machine type configuration.")
+    # The source image is the same for every zone, so look it up once
+    image_project = compute_config['instance_config']['image_project']
+    image_family = compute_config['instance_config']['image_family']
+    image_response = execute_with_retry(compute.images().getFromFamily(
+        project=image_project, family=image_family, fields='selfLink'))
+    source_disk_image = image_response['selfLink']
+    instance_template = build_instance_template(compute_config, source_disk_image)
+    # Zones are tried region by region, with up to number_of_instances attempts in flight at once
+    zone_queue = deque(itertools.chain.from_iterable(regional_zone_lists.values()))
+    exhausted_regions = set()
+    # Instances each region still has GPU quota for; regions with unknown quota have no limit
+    number_of_gpus = compute_config['instance_config']['number_of_gpus']
+    region_budget = {region: zones[0]['regional_remaining_gpus'] // number_of_gpus
+                     for region, zones in regional_zone_lists.items()
+                     if zones[0].get('regional_remaining_gpus') is not None}
+    in_flight = defaultdict(int)
+    created_instances = []
+    pending = {}
+    attempts = 0
+    creation_error = None
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while True:
+            # After a hard failure nothing new is dispatched, but the attempts already in
+            # flight are still waited on so that any instance they create is returned.
+            # Zones of a region with no quota left for another attempt stay queued, and
+            # the next region gets the attempt instead.
+            for zone_config in list(zone_queue):
+                if creation_error is not None or len(created_instances) + len(pending) >= number_of_instances:
                     break
-            if instances >= compute_config['number_of_instances']:
+                region = zone_config['region']
+                if region in exhausted_regions:
+                    zone_queue.remove(zone_config)
+                    continue
+                if region in region_budget and in_flight[region] >= region_budget[region]:
+                    continue
+                zone_queue.remove(zone_config)
+                in_flight[region] += 1
+                attempts += 1
+                instance_name = compute_config['instance_config']['name'] + '-' + str(attempts) + '-' + zone_config['zone']
+                print(f"Creating instance {instance_name} in {zone_config['zone']}, {len(zone_queue)} zones left to try.")
+                future = executor.submit(create_single_instance, compute, project, compute_config, zone_config, instance_name, instance_template)
+                pending[future] = (instance_name, zone_config)
+            if not pending:
                 break
-            elif move_regions == 1:
-                break
-            zones_attempted += 1
-        regions_attempted += 1
-        if instances >= compute_config['number_of_instances']:
-            break
-        elif regions_attempted >= len(regions_to_try):
-            print(f"All regions attempted, there are not enough resources to create the desired {compute_config['number_of_instances']} instances, {instances} created")
-            break
+            done, _ = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                instance_name, zone_config = pending.pop(future)
+                in_flight[zone_config['region']] -= 1
+                try:
+                    created = future.result()
+                except Exception as e:
+                    print(f"Failed to create {instance_name}: {e}")
+                    if creation_error is None:
+                        creation_error = e
+                    continue
+                if created:
+                    instance_details = {
+                        "name": instance_name,
+                        "zone": zone_config['zone']
+                    }
+                    created_instances.append(instance_details)
+                    if zone_config['region'] in region_budget:
+                        region_budget[zone_config['region']] -= 1
+                    print(f"{len(created_instances)} created, {number_of_instances-len(created_instances)} more to create")
+                    # The zone had capacity, so try it again first for the next instance
+                    zone_queue.appendleft(zone_config)
+                elif zone_config['region'] not in exhausted_regions:
+                    exhausted_regions.add(zone_config['region'])
+                    print(f"Quota exceeded in region {zone_config['region']}, moving to next region")
+    if creation_error is not None:
+        raise InstanceCreationError(created_instances) from creation_error
+    if len(created_instances) >= number_of_instances:
+        print(f"Reached the desired number of instances")
+    else:
+        print(f"All regions attempted, there are not enough resources to create the desired {number_of_instances} instances, {len(created_instances)} created")
     return(created_instances)
-    time.sleep(1)
 
 def delete_instance(compute, project, instance_details):
     instances = instance_details
     print(f"Deleting {len(instances)} instances.")
-    for i in range(len(instances)):
-        instance = instances[i]
-        zone = instance["zone"]
-        name = instance["name"]
+    operations = {}
+
+    def on_delete(request_id, response, exception):
+        if exception is not None:
+            raise exception
+        operations[int(request_id)] = response['name']
 
-        print(f"Deleting instance {name}.")
-        operation = compute.instances().delete(
+    requests = []
+    for instance in instances:
+        print(f"Deleting instance {instance['name']}.")
+        requests.append(compute.instances().delete(
             project=project,
-            zone=zone,
-            instance=name).execute()
+            zone=instance['zone'],
+            instance=instance['name'],
+            requestId=str(uuid.uuid4())))
+    execute_in_batches(compute, requests, on_delete)
 
-        print('Waiting for operation to finish...')
-        while True:
-            result = compute.zoneOperations().get(
-                project=project,
-                zone=zone,
-                operation=operation['name']).execute()
-
-            if result['status'] == 'DONE':
-                print("done.")
-                if 'error' in result:
-                    raise Exception(result['error'])
-                break
+    print('Waiting for operations to finish...')
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(poll_operation, compute, project, instances[i]['zone'], operation_name): instances[i]
+                   for i, operation_name in operations.items()}
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"Deleting {futures[future]['name']} done.")
+            if 'error' in result:
+                raise Exception(result['error'])
+
+def execute_in_batches(compute, requests, callback, list_next=None):
+    # Packs up to MAX_BATCH_SIZE requests into each batch HTTP call. Request ids are
+    # the position in requests, and when list_next is given, follow-up pages are
+    # queued into the next batch.
+    request_ids = itertools.count()
+    pending = list(requests)
+    while pending:
+        batch_requests = {str(next(request_ids)): r for r in pending[:MAX_BATCH_SIZE]}
+        pending = pending[MAX_BATCH_SIZE:]
+
+        callback_errors = []
+
+        def handle_response(request_id, response, exception):
+            if isinstance(exception, HttpError) and exception.resp.status in RETRY_STATUSES:
+                try:
+                    response, exception = execute_with_retry(batch_requests[request_id]), None
+                except HttpError as e:
+                    response, exception = None, e
+            try:
+                callback(request_id, response, exception)
+            except Exception as e:
+                # Raised once the batch is done, so execute_with_retry(batch) below
+                # only ever retries a failure of the batch POST itself.
+                callback_errors.append(e)
+                return
+            if list_next is not None and exception is None:
+                next_request = list_next(previous_request=batch_requests[request_id], previous_response=response)
+                if next_request is not None:
+                    pending.append(next_request)
+
+        batch = compute.new_batch_http_request(callback=handle_response)
+        for request_id, request in batch_requests.items():
+            batch.add(request, request_id=request_id)
+        execute_with_retry(batch)
+        if callback_errors:
+            raise callback_errors[0]
 
 def create_instance_test(compute, project, config, zone, requested_gpus):
     zone_list = zone
-    accelerator_list = []
-    for i in zone_list:
-        request = compute.acceleratorTypes().list(project=project, zone=i['zone'])
-        while request is not None:
-            response = request.execute()
-            if 'items' in response:
-                for accelerator in response['items']:
-                    print(accelerator)
+
+    def print_accelerators(request_id, response, exception):
+        if exception is not None:
+            raise exception
+        for accelerator in response.get('items', []):
+            print(accelerator)
+
+    requests = [compute.acceleratorTypes().list(project=project, zone=i['zone']) for i in zone_list]
+    execute_in_batches(compute, requests, print_accelerators, list_next=compute.acceleratorTypes().list_next)
 
 
 def main(gpu_config, wait=True):
-    compute = googleapiclient.discovery.build('compute', 'v1')
+    compute = googleapiclient.discovery.build('compute', 'v1', requestBuilder=build_request, cache_discovery=False)
     if gpu_config["instance_config"]["zone"]:
         print(f"Processing selected zones from {gpu_config['instance_config']['zone']}")
         zone_info = get_zone_info(compute, gpu_config["project_id"])
-        compute_zones = [z for z in zone_info if z['zone'] in gpu_config['instance_config']['zone']]
+        selected_zones = frozenset(gpu_config['instance_config']['zone'])
+        compute_zones = [z for z in zone_info if z['zone'] in selected_zones]
     else:
         print("Processing all zones")
         compute_zones = get_zone_info(compute, gpu_config["project_id"])
@@ -336,10 +563,16 @@ def main(gpu_config, wait=True):
     # distinct_zones = list({v['zone'] for v in compute_zones})
     available_zones = check_machine_type_and_accelerator(compute, gpu_config["project_id"], gpu_config["instance_config"]["machine_type"], gpu_config["instance_config"]["gpu_type"], compute_zones)
     accelerators = get_accelerator_quota(compute, gpu_config["project_id"], gpu_config, available_zones, gpu_config["instance_config"]["number_of_gpus"])
+    accelerators = check_gpu_quota(compute, gpu_config["project_id"], gpu_config, accelerators, gpu_config["instance_config"]["number_of_gpus"])
     available_regions = list({v['region'] for v in available_zones})
     if available_regions:
         print(f"Machine type {gpu_config['instance_config']['machine_type']} is available in the following regions: {available_regions}")
-        instance_details = create_instance(compute, gpu_config["project_id"], gpu_config, accelerators)
+        try:
+            instance_details = create_instance(compute, gpu_config["project_id"], gpu_config, accelerators)
+        except InstanceCreationError as e:
+            if e.created_instances:
+                delete_instance(compute, gpu_config["project_id"], e.created_instances)
+            raise
         if wait:
             print("hit enter to delete instances")
             input()